@@ -6,9 +6,10 @@ commands or doing checks.
 """
 
 import re
+from collections import defaultdict
+from operator import itemgetter
 
 import numpy as np
-
 from cxotime import CxoTime
 
 from .utils import un_camel_case
@@ -16,6 +17,50 @@ from .utils import un_camel_case
 CMD_ACTION_CLASSES = set()
 CHECK_CLASSES = {}
 
+# Command-action classes indexed by the (type, tlmsid) values required by their
+# cmd_trigger, with None in place of either one that is not required.  Classes
+# which require an ``action`` value are instead indexed by that action name in
+# ACTION_DISPATCH.  Classes with a custom ``trigger`` method can match any
+# command so they go in the catch-all (None, None) entry.
+CMD_ACTION_DISPATCH = defaultdict(list)
+ACTION_DISPATCH = defaultdict(list)
+
+
+def _make_trigger(cmd_trigger):
+    """
+    Return a function ``trigger(cmd)`` specialized for ``cmd_trigger``.
+
+    The key / value tests are unrolled into a single boolean expression so
+    that testing each command does no dict iteration.  Keys and values are
+    bound in the function namespace rather than being written into the
+    source text.
+
+    :param cmd_trigger: dict of command keys and required values
+    """
+    namespace = {}
+    tests = []
+    for idx, (key, val) in enumerate(cmd_trigger.items()):
+        namespace['key{}'.format(idx)] = key
+        namespace['val{}'.format(idx)] = val
+        tests.append('cmd.get(key{0}) == val{0}'.format(idx))
+
+    src = 'def trigger(cmd):\n    return {}\n'.format(' and '.join(tests) or 'True')
+    exec(src, namespace)
+    return namespace['trigger']
+
+
+def _has_custom_trigger(cls):
+    """
+    Return True if ``cls`` defines or inherits a ``trigger`` method other than
+    the generic ``CmdActionCheck.trigger`` or one generated from ``cmd_trigger``.
+    """
+    for base in cls.__mro__:
+        if 'trigger' in vars(base):
+            return (base is not CmdActionCheck
+                    and '_generated_trigger' not in vars(base))
+    return False
+
+
 class CmdActionMeta(type):
     """Metaclass to register CmdAction classes and auto-generate ``name`` and
     ``cmd_trigger`` class attributes for ``Cmd`` and ``Action`` subclasses.
@@ -36,7 +81,7 @@ class CmdActionMeta(type):
 
     """
     def __init__(cls, name, bases, dct):
-        super(CmdActionMeta, cls).__init__(name, bases, dct)
+        super().__init__(name, bases, dct)
 
         if 'abstract' in dct:
             return
@@ -48,6 +93,19 @@ class CmdActionMeta(type):
         if cls.type == 'action':
             cls.cmd_trigger = {'action': cls.name}
 
+        # Replace the generic trigger with one specialized for cmd_trigger,
+        # unless the class provides its own trigger method.
+        cmd_trigger = getattr(cls, 'cmd_trigger', None)
+        custom_trigger = _has_custom_trigger(cls)
+        if cmd_trigger is not None and not custom_trigger:
+            cls.trigger = staticmethod(_make_trigger(cmd_trigger))
+            cls._generated_trigger = True
+
+        # Pre-compute the state names and a getter for the corresponding cmd
+        # values for StateValueCmd classes.
+        if getattr(cls, 'cmd_key', None) is not None:
+            cls._state_names, cls._get_values = _make_state_value_getter(cls)
+
         # Checks are captured by name in a dict instead of a list.  This is
         # because checks are processed separately after the main run of commands
         # and therefore they can simply be looked up instead of requiring a
@@ -57,6 +115,71 @@ class CmdActionMeta(type):
 
         else:
             CMD_ACTION_CLASSES.add(cls)
+            cmd_trigger = getattr(cls, 'cmd_trigger', None) or {}
+            if custom_trigger:
+                CMD_ACTION_DISPATCH[(None, None)].append(cls)
+            elif 'action' in cmd_trigger:
+                ACTION_DISPATCH[cmd_trigger['action']].append(cls)
+            else:
+                key = (cmd_trigger.get('type'), cmd_trigger.get('tlmsid'))
+                CMD_ACTION_DISPATCH[key].append(cls)
+
+
+def _make_state_value_getter(cls):
+    """
+    Return the tuple of state names and a function ``get_values(cmd)`` which
+    returns the tuple of corresponding values from ``cmd`` for a class with
+    ``state_name`` and ``cmd_key`` attributes.
+    """
+    state_names = (tuple(cls.state_name) if isinstance(cls.state_name, (tuple, list))
+                   else (cls.state_name,))
+    cmd_keys = (tuple(cls.cmd_key) if isinstance(cls.cmd_key, (tuple, list))
+                else (cls.cmd_key,))
+
+    if len(cmd_keys) != len(state_names):
+        raise ValueError('length of cmd_key {} != length of state_name {}'
+                         .format(len(cmd_keys), len(state_names)))
+
+    if len(cmd_keys) == 1:
+        cmd_key = cmd_keys[0]
+
+        def get_values(cmd):
+            return (cmd[cmd_key],)
+    else:
+        get_values = itemgetter(*cmd_keys)
+
+    return state_names, staticmethod(get_values)
+
+
+def get_cmd_action_classes(cmd):
+    """
+    Get the command-action classes which might be triggered by ``cmd``.
+
+    This uses the ``type`` and ``tlmsid`` of ``cmd`` to select the candidates
+    from CMD_ACTION_DISPATCH, and the ``action`` (if any) to select candidates
+    from ACTION_DISPATCH, so the full ``trigger`` of each candidate must still
+    be checked.
+
+    :param cmd: command dict
+    :returns: list of CmdActionCheck classes
+    """
+    type_ = cmd.get('type')
+    tlmsid = cmd.get('tlmsid')
+
+    # Use dict.fromkeys to drop duplicate keys (when type or tlmsid is None)
+    # while keeping the order.
+    keys = dict.fromkeys([(type_, tlmsid), (None, tlmsid), (type_, None), (None, None)])
+
+    classes = []
+    for key in keys:
+        if key in CMD_ACTION_DISPATCH:
+            classes.extend(CMD_ACTION_DISPATCH[key])
+
+    action = cmd.get('action')
+    if action in ACTION_DISPATCH:
+        classes.extend(ACTION_DISPATCH[action])
+
+    return classes
 
 
 class CmdActionCheck(metaclass=CmdActionMeta):
@@ -71,12 +194,13 @@ class CmdActionCheck(metaclass=CmdActionMeta):
 
     @classmethod
     def trigger(cls, cmd):
-        ok = all(cmd.get(key) == val
-                 for key, val in cls.cmd_trigger.items())
-        return ok
+        for key, val in cls.cmd_trigger.items():
+            if cmd.get(key) != val:
+                return False
+        return True
 
     def run(self):
-        raise NotImplemented()
+        raise NotImplementedError()
 
 
 class Cmd(CmdActionCheck):
@@ -102,20 +226,11 @@ class StateValueCmd(Cmd):
     abstract = True
 
     def run(self):
-        state_names = (self.state_name if isinstance(self.state_name, (tuple, list))
-                       else (self.state_name,))
-
-        if isinstance(self.cmd_key, (tuple, list)):
-            values = tuple(self.cmd[key] for key in self.cmd_key)
-        else:
-            values = (self.cmd[self.cmd_key],)
-
-        if len(values) != len(state_names):
-            raise ValueError('length of values {} != length of state_names {}'
-                             .format(len(values), len(state_names)))
-
-        for state_name, value in zip(state_names, values):
-            setattr(self.SC, state_name, value)
+        # _state_names and _get_values are set by CmdActionMeta from the
+        # state_name and cmd_key class attributes.
+        SC = self.SC
+        for state_name, value in zip(self._state_names, self._get_values(self.cmd)):
+            setattr(SC, state_name, value)
 
 
 class FixedStateValueCmd(Cmd):
@@ -206,12 +321,17 @@ class CmdSequenceCheck(Check):
         time = self.base_time + time_offset
         min_date = (time - tolerance).date
         max_date = (time + tolerance).date
+        # SC.cmd_dates (sorted array of all command dates) is set at the end of
+        # processing commands, before checks are run.
         i_min = np.searchsorted(SC.cmd_dates, min_date, side='left')
         i_max = np.searchsorted(SC.cmd_dates, max_date, side='right') + 1
 
         matches = []
         for cmd in SC.cmds[i_min:i_max]:
-            if all(cmd.get(key) == val for key, val in cmd_match.items()):
+            for key, val in cmd_match.items():
+                if cmd.get(key) != val:
+                    break
+            else:
                 matches.append(cmd)
 
         n_match = len(matches)
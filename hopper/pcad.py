@@ -3,18 +3,45 @@
 Commands, Actions, and checks for PCAD
 """
 
-import numpy as np
-from astropy.coordinates import SkyCoord
-from astropy.table import Table
+import math
+from functools import lru_cache
+
 import astropy.units as u
 
-import chandra_aca
 from Quaternion import Quat
-import Chandra.Maneuver
 from cxotime import CxoTime
 
 from .base_cmd import (Cmd, StateValueCmd, FixedStateValueCmd, Action, Check,
                        CmdSequenceCheck)
+from .utils import as_dates
+
+# Scalar unit conversions for command parameters
+_RAD2DEG = 180.0 / math.pi
+_TWOPI = 2.0 * math.pi
+
+
+def _sep_arcsec(ra1, dec1, ra2, dec2):
+    """
+    Angular separation (arcsec) between two RA, Dec positions (deg).
+
+    This uses the haversine formula which is accurate for small separations.
+    Inputs are scalars so this uses the math module instead of numpy ufuncs.
+    """
+    ra1, dec1, ra2, dec2 = (math.radians(val) for val in (ra1, dec1, ra2, dec2))
+    hav = (math.sin((dec2 - dec1) / 2) ** 2
+           + math.cos(dec1) * math.cos(dec2) * math.sin((ra2 - ra1) / 2) ** 2)
+    return math.degrees(2 * math.asin(math.sqrt(min(hav, 1.0)))) * 3600
+
+
+@lru_cache(maxsize=1)
+def _default_si_align_quat():
+    """
+    Quat for the chandra_aca default ODB_SI_ALIGN matrix.  This is computed once
+    so calc_targ_from_aca does not convert the matrix on every call.
+    """
+    from chandra_aca.transform import ODB_SI_ALIGN
+    return Quat(ODB_SI_ALIGN)
+
 
 class TargQAttCmd(StateValueCmd):
     """
@@ -54,37 +81,45 @@ class DitherParmsCmd(Cmd):
     def run(self):
         SC = self.SC
         cmd = self.cmd
-        SC.dither_phase_pitch = np.degrees(cmd['angp'])
-        SC.dither_phase_yaw = np.degrees(cmd['angy'])
-        SC.dither_ampl_pitch = np.degrees(cmd['coefp']) * 3600
-        SC.dither_ampl_yaw = np.degrees(cmd['coefy']) * 3600
-        SC.dither_period_pitch = 2 * np.pi / cmd['ratep']
-        SC.dither_period_yaw = 2 * np.pi / cmd['ratey']
+        SC.dither_phase_pitch = cmd['angp'] * _RAD2DEG
+        SC.dither_phase_yaw = cmd['angy'] * _RAD2DEG
+        SC.dither_ampl_pitch = cmd['coefp'] * _RAD2DEG * 3600
+        SC.dither_ampl_yaw = cmd['coefy'] * _RAD2DEG * 3600
+        SC.dither_period_pitch = _TWOPI / cmd['ratep']
+        SC.dither_period_yaw = _TWOPI / cmd['ratey']
 
 class ManeuverCmd(Cmd):
     cmd_trigger = {'tlmsid': 'AOMANUVR'}
 
     def run(self):
+        # Expensive import so do this locally
+        import Chandra.Maneuver
+
         SC = self.SC
         atts = Chandra.Maneuver.attitudes([SC.q1, SC.q2, SC.q3, SC.q4],
                                           [SC.targ_q1, SC.targ_q2, SC.targ_q3, SC.targ_q4],
                                           step=300, tstart=self.cmd['date'])
-        for att in atts:
-            SC.add_action('set_qatt',
-                          date=att['time'], q1=att['q1'], q2=att['q2'], q3=att['q3'], q4=att['q4'])
-            SC.add_action('set_pitch', date=att['time'], pitch=att['pitch'])
 
+        # Add attitude and pitch updates during the maneuver as set_att actions
+        dates = as_dates(atts['time']).tolist()
+        cols = [atts[name].tolist() for name in ('q1', 'q2', 'q3', 'q4', 'pitch')]
+        cmds = [{'action': 'set_att', 'date': date,
+                 'q1': q1, 'q2': q2, 'q3': q3, 'q4': q4, 'pitch': pitch}
+                for date, q1, q2, q3, q4, pitch in zip(dates, *cols)]
+        SC.add_cmds(cmds)
+
+        # Maneuver start and end come from the same converted dates
         att0 = atts[0]
         att1 = atts[-1]
-        time0 = CxoTime(att0['time'])
-        time1 = CxoTime(att1['time'])
-        maneuver = {'initial': {'date': time0.date,
+        date0 = dates[0]
+        date1 = dates[-1]
+        maneuver = {'initial': {'date': date0, 'time': float(att0['time']),
                                 'obsid': SC.obsid,
                                 'q1': att0['q1'], 'q2': att0['q2'], 'q3': att0['q3'], 'q4':att0['q4']},
-                    'final': {'date': time1.date,
+                    'final': {'date': date1, 'time': float(att1['time']),
                               # final obsid filled in at the end of the maneuver
                               'q1': att1['q1'], 'q2': att1['q2'], 'q3': att1['q3'], 'q4':att1['q4']},
-                    'dur': round((time1 - time0).sec, 3)}
+                    'dur': round(att1['time'] - att0['time'], 3)}
 
         # Add the summary dict of maneuver info as a spacecraft state
         SC.maneuver = maneuver
@@ -98,9 +133,9 @@ class ManeuverCmd(Cmd):
         # happens immediately.
         if SC.auto_npm_transition:
             if SC.starcheck:
-                SC.add_action('auto_npm', time1)
+                SC.add_action('auto_npm', date1)
             else:
-                SC.add_action('auto_npm_with_star_checking', time1)
+                SC.add_action('auto_npm_with_star_checking', date1)
 
 
 
@@ -150,10 +185,11 @@ class AutoNpmWithStarCheckingAction(Action):
         SC.add_action('aca.fid_lights', npm_time)
 
         # Check dither parameters at a time when they will be at the final values
-        SC.add_check('standard_dither', npm_time + 8 * u.min)
+        dither_check_time = npm_time + 8 * u.min
+        SC.add_check('standard_dither', dither_check_time)
 
         # Add checks for dither disable / enable sequence if dither is large
-        SC.add_check('large_dither_cmd_sequence', npm_time + 8 * u.min)
+        SC.add_check('large_dither_cmd_sequence', dither_check_time)
 
 
 class AutoNpm(Action):
@@ -201,6 +237,15 @@ class SetPitchAction(Action, StateValueCmd):
     cmd_key = 'pitch'
 
 
+class SetAttAction(Action, StateValueCmd):
+    """
+    Action to update current attitude quaternion and Sun pitch angle together.
+    This is used for the attitude samples during a maneuver.
+    """
+    state_name = 'q1', 'q2', 'q3', 'q4', 'pitch'
+    cmd_key = 'q1', 'q2', 'q3', 'q4', 'pitch'
+
+
 class SetManeuverObsid(Action):
     """
     Set the obsid for the current maneuver to the current obsid.
@@ -222,6 +267,9 @@ class AttitudeConsistentWithObsreqCheck(Check):
     description = 'Science target attitude matches OR list for obsid'
 
     def run(self):
+        # Expensive import so do this locally
+        import chandra_aca
+
         SC = self.SC
         obsid = SC.obsid
 
@@ -235,51 +283,47 @@ class AttitudeConsistentWithObsreqCheck(Check):
             self.add_message('error', 'obsid {} does not have RA/Dec in OR'.format(obsid))
 
         else:
-            obsreq = SC.obsreqs[obsid]
-
-
             # Gather inputs for doing conversion from spacecraft target attitude
-            # to science target attitude.  Add in the dynamical offset attributes
-            # which are available for loads planned with Matlab tools 2016_210
-            # and later.  These pseudo-attributes must be injected by calling code.
-            y_off = obsreq['target_offset']['y_offset'] + obsreq.get('aca_offset_y', 0)
-            z_off = obsreq['target_offset']['z_offset'] + obsreq.get('aca_offset_z', 0)
-            targ = SkyCoord(obsreq['target']['ra'], obsreq['target']['dec'], unit='deg')
-            pcad = Quat([SC.targ_q1, SC.targ_q2, SC.targ_q3, SC.targ_q4])
+            # to science target attitude.
+            y_off, z_off, targ_ra, targ_dec = SC.get_obsreq_target(obsid)
+            pcad = SC.targ_q_att
             detector = SC.detector
 
             # Products are planned using the Matlab tools SI align which matches the
             # baseline mission align matrix from pre-November 2015.
             if SC.characteristics is None or 'odb_si_align' not in SC.characteristics:
-                from chandra_aca.transform import ODB_SI_ALIGN
-                si_align = ODB_SI_ALIGN
+                si_align = _default_si_align_quat()
+            elif 'odb_si_align_quat' in SC.characteristics:
+                si_align = SC.characteristics['odb_si_align_quat'][detector]
             else:
                 si_align = SC.characteristics['odb_si_align'][detector]
 
             q_targ = chandra_aca.calc_targ_from_aca(pcad, y_off, z_off, si_align)
-            cmd_targ = SkyCoord(q_targ.ra, q_targ.dec, unit='deg')
 
-            sep = targ.separation(cmd_targ)
-            if sep > 1. * u.arcsec:
+            sep = _sep_arcsec(targ_ra, targ_dec, q_targ.ra, q_targ.dec)
+            if sep > 1.:
                 message = ('science target attitude RA={:.5f} Dec={:.5f} different '
-                           'from OR list by {:.1f}'
-                           .format(q_targ.ra, q_targ.dec, sep.to('arcsec')))
+                           'from OR list by {:.1f} arcsec'
+                           .format(q_targ.ra, q_targ.dec, sep))
                 self.add_message('error', message)
 
 
 class StandardDitherCheck(Check):
     description = 'Dither parameters match one of the standard sets'
+    _STANDARD_NAMES = ('dither_period_pitch', 'dither_period_yaw',
+                       'dither_ampl_pitch', 'dither_ampl_yaw')
+    _STANDARDS = (dict(dither_period_pitch=1087.0, dither_period_yaw=768.6,
+                       dither_ampl_pitch=20, dither_ampl_yaw=20),
+                  dict(dither_period_pitch=1000.0, dither_period_yaw=707.1,
+                       dither_ampl_pitch=8, dither_ampl_yaw=8))
 
     def run(self):
         SC = self.SC
-        standards = Table(dict(dither_period_pitch=[1087.0, 1000.0],
-                               dither_period_yaw=[768.6, 707.1],
-                               dither_ampl_pitch=[20, 8],
-                               dither_ampl_yaw=[20, 8]))
-
-        for standard in standards:
-            if all(np.allclose(getattr(SC, name), standard[name], rtol=0.001)
-                   for name in standards.colnames):
+        values = {name: getattr(SC, name) for name in self._STANDARD_NAMES}
+
+        for standard in self._STANDARDS:
+            if all(math.isclose(values[name], standard[name], rel_tol=0.001)
+                   for name in self._STANDARD_NAMES):
                 break
         else:
             self.add_message('warning', 'non-standard dither amplitude or period')
@@ -304,7 +348,7 @@ class LargeDitherCmdSequenceCheck(CmdSequenceCheck):
         if self.SC.dither_ampl_pitch < 30 and self.SC.dither_ampl_yaw < 30:
             self.not_applicable = True
             return
-        super(LargeDitherCmdSequenceCheck, self).run()
+        super().run()
 
     @property
     def base_time(self):
@@ -313,4 +357,4 @@ class LargeDitherCmdSequenceCheck(CmdSequenceCheck):
         NPM).  The ATS actually schedules things relative to 10 seconds BEFORE
         the end of the maneuver.
         """
-        return CxoTime(self.SC.maneuver['final']['date']) - 10 * u.s
+        return CxoTime(self.SC.maneuver['final']['time'] - 10)
@@ -3,8 +3,10 @@
 """
 
 
-from collections import OrderedDict
-from copy import copy
+import logging
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from operator import itemgetter
 
 import numpy as np
 
@@ -17,7 +19,7 @@ from .utils import as_date, get_backstop_cmds
 logger = pyyaks.logger.get_logger(name='hopper', level=pyyaks.logger.INFO,
                                   format="%(message)s")
 
-from .base_cmd import CMD_ACTION_CLASSES, CHECK_CLASSES, CmdActionCheck
+from .base_cmd import CHECK_CLASSES, CmdActionCheck, get_cmd_action_classes
 
 STATE0 = {'q1': 0.0, 'q2': 0.0, 'q3':0.0, 'q4': 1.0,
           'targ_q1': 0.0, 'targ_q2': 0.0, 'targ_q3':0.0, 'targ_q4': 1.0,
@@ -33,13 +35,52 @@ STATE0 = {'q1': 0.0, 'q2': 0.0, 'q3':0.0, 'q4': 1.0,
           'dither_period_yaw': 707.1
 }
 
-class StateValue(object):
+# SIM translation position bins for each detector.  A position in the interval
+# (_SIM_BINS[i], _SIM_BINS[i + 1]] corresponds to detector _SIM_DETS[i].
+_SIM_BINS = (-400000.0, -85000.0, 0.0, 83000.0, 400000.0)
+_SIM_DETS = ('HRC-S', 'HRC-I', 'ACIS-S', 'ACIS-I')
+
+
+@lru_cache(maxsize=256)
+def _quat(q1, q2, q3, q4):
+    """
+    Return the Quat for components ``q1, q2, q3, q4``.  This is cached since
+    the same attitude is typically read many times.
+    """
+    return Quat([q1, q2, q3, q4])
+
+
+@lru_cache(maxsize=4)
+def _detector_for(simpos):
+    """
+    Return the detector name for SIM translation position ``simpos``.
+    """
+    idx = bisect_left(_SIM_BINS, simpos) - 1
+    if not 0 <= idx < len(_SIM_DETS):
+        raise ValueError('illegal value of sim_tsc: {}'.format(simpos))
+    return _SIM_DETS[idx]
+
+
+class StateValue:
+    __slots__ = ('name', 'values', '_dates', '_dates_arr')
+
     def __init__(self):
         self.clear()
 
     def clear(self):
         self.values = []
-        self.dates = np.ndarray(shape=(0,), dtype='S21')
+        self._dates = []
+        self._dates_arr = None
+
+    @property
+    def dates(self):
+        """
+        Sample dates as a numpy array.  This is built from the list of dates
+        on demand and cached until the next sample is set.
+        """
+        if self._dates_arr is None:
+            self._dates_arr = np.array(self._dates, dtype='S21')
+        return self._dates_arr
 
     def __get__(self, SC, cls):
         """
@@ -53,38 +94,91 @@ class StateValue(object):
           dates = [0, 1, 2, 2, 3]  # idx = 1 for date=1.0
           dates = [0, 1, 2, 2, 3]  # idx = 1 for date=1.1
         """
+        # Accessed from the class, e.g. Spacecraft.obsid.get_many(dates)
+        if SC is None:
+            return self
+
         # No samples defined yet, return None
-        if len(self.dates) == 0:
+        if len(self._dates) == 0:
             return None
 
-        # Return last sample before or at the current SC date
+        # Return last sample before or at the current SC date.  While running
+        # commands this is nearly always the most recent sample, so check that
+        # before searching.
         date = SC.date
-        idx = np.searchsorted(self.dates, date, side='right') - 1
+        if self._dates[-1] <= date:
+            return self.values[-1]
+        idx = bisect_right(self._dates, date) - 1
         return self.values[idx] if (idx >= 0) else None
 
     def __set__(self, SC, value):
         date = SC.date
 
-        logger.debug('%s %s=%s', date, self.name, value)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s %s=%s', date, self.name, value)
+
+        self.append(date, value)
+        SC.set_state_value(date, self.name, value)
 
-        self.value = value
+    def append(self, date, value):
+        """
+        Append a sample ``value`` at ``date`` without updating the spacecraft
+        state history.
+        """
         self.values.append(value)
-        self.dates.resize(len(self.values))
-        self.dates[-1] = date
+        self._dates.append(date)
+        self._dates_arr = None
 
-        SC.set_state_value(date, self.name, value)
+    def get_many(self, dates):
+        """
+        Get the value at the last sample which occurs before or at each of
+        ``dates``.  Each date is converted to Year DOY with ``as_date`` (so
+        inputs may be in mixed formats) and then all dates are looked up with a
+        single vectorized search.
+
+        :param dates: list or array of time-like inputs
+        :returns: list of values (None for dates before the first sample)
+        """
+        if len(dates) == 0:
+            return []
+        if len(self._dates) == 0:
+            return [None] * len(dates)
+
+        dates = np.array([as_date(date) for date in dates], dtype='S21')
+
+        idxs = np.searchsorted(self.dates, dates, side='right') - 1
+        values = self.values
+        return [values[idx] if (idx >= 0) else None for idx in idxs]
+
+
+def _state_value_property(state_value, attr):
+    """
+    Make a read-only property returning ``attr`` (``values`` or ``dates``) of
+    ``state_value``.
+    """
+    return property(lambda self: getattr(state_value, attr),
+                    doc='{} of state {}'.format(attr, state_value.name))
 
 
 class SpacecraftMeta(type):
     def __init__(cls, name, bases, dct):
-        super(SpacecraftMeta, cls).__init__(name, bases, dct)
+        super().__init__(name, bases, dct)
 
+        # Collect the StateValue attributes (including from base classes) and
+        # add properties e.g. obsids and obsid_dates giving the history of
+        # values and dates for each one.
+        state_values = dict(getattr(cls, '_state_values', {}))
         for name, val in dct.items():
             if isinstance(val, StateValue):
                 val.name = name
+                state_values[name] = val
+                for suffix, attr in (('s', 'values'), ('_dates', 'dates')):
+                    if name + suffix not in dct:
+                        setattr(cls, name + suffix, _state_value_property(val, attr))
+        cls._state_values = state_values
 
 
-class Spacecraft(object, metaclass=SpacecraftMeta):
+class Spacecraft(metaclass=SpacecraftMeta):
     simpos = StateValue()
     simfa_pos = StateValue()
     obsid = StateValue()
@@ -117,39 +211,55 @@ class Spacecraft(object, metaclass=SpacecraftMeta):
         # self as the parent.
         CmdActionCheck.SC = self
 
-        class_dict = self.__class__.__dict__
-
-        for attr in class_dict.values():
-            if isinstance(attr, StateValue):
-                attr.clear()
+        state_values = self._state_values
+        for state_value in state_values.values():
+            state_value.clear()
 
         if isinstance(cmds, str):
             cmds = get_backstop_cmds(cmds)
         self.cmds = cmds
+        # Parallel list of command dates, kept in sync with self.cmds by
+        # add_cmd so that insertion points can be found by binary search.
+        self._cmd_dates = [cmd['date'] for cmd in cmds]
         self.obsreqs = obsreqs if obsreqs else None
+        self._obsreq_targets = {}
         self.characteristics = characteristics
         # If starcheck is True, and hopper was called from starcheck, run in a reduced mode that
         # skips the star catalog checks (they are already being done independently in starcheck)
         self.starcheck = starcheck
+        # Checks are kept sorted by date as they are added, with a parallel
+        # list of dates for finding the insertion point.
         self.checks = []
+        self._check_dates = []
 
         # Make the initial spacecraft "state" dict from user-supplied values, with
         # defaults provided by STATE0
-        state0 = copy(STATE0)
-        state0.update(initial_state or {})
-
-        self.date = state0.pop('date')
-        self.states = [{attr: getattr(self, attr) for attr, val in class_dict.items()
-                        if isinstance(val, StateValue)}]
-        self.states[0]['date'] = self.date
+        state0 = {**STATE0, **(initial_state or {})}
 
-        for key, val in state0.items():
-            if key in class_dict and isinstance(class_dict[key], StateValue):
-                setattr(self, key, val)
-            else:
+        for key in state0:
+            if key != 'date' and key not in state_values:
                 raise AttributeError('key {} is not a StateValue class attribute'
                                      .format(key))
 
+        self.date = state0.pop('date')
+        self._state0 = dict.fromkeys(state_values)
+        self._state0['date'] = self.date
+
+        # State history is kept as a log of (date, name, value) changes from
+        # which the list of states is built on demand.  self.state is the
+        # current (most recent) state.  Initial values are recorded directly
+        # in one pass instead of through StateValue.__set__.
+        self.state = self._state0.copy()
+        self._state_deltas = []
+        date0 = as_date(self.date)
+        for key, val in state0.items():
+            state_values[key].append(self.date, val)
+            self._state_deltas.append((date0, key, val))
+        if state0:
+            self.state.update(state0)
+            self.state['date'] = date0
+        self._states = None
+
     def run(self):
         """
         Interpret the sequence of commands ``self.cmds``, triggering an action
@@ -161,7 +271,7 @@ class Spacecraft(object, metaclass=SpacecraftMeta):
         for self.i_cmd, cmd in enumerate(self.cmds):
             self.date = cmd['date']
 
-            for cmd_action_class in CMD_ACTION_CLASSES:
+            for cmd_action_class in get_cmd_action_classes(cmd):
                 if cmd_action_class.trigger(cmd):
                     cmd_action = cmd_action_class(cmd)
                     cmd_action.run()
@@ -169,25 +279,13 @@ class Spacecraft(object, metaclass=SpacecraftMeta):
 
         # Once all commands are assembled then make a numpy array of command dates.
         # This is useful for finding commands by date later.
-        self.cmd_dates = np.array([cmd['date'] for cmd in self.cmds])
+        self.cmd_dates = np.array(self._cmd_dates)
 
-        # Sort the checks by date and then execute each one
-        self.checks = sorted(self.checks, key=lambda x: x.date)
+        # Execute each check (already sorted by date in add_check)
         for check in self.checks:
             self.date = check.date
             check.run()
 
-    def __getattr__(self, attr):
-        cls_dict = self.__class__.__dict__
-        for ending in ('s', '_dates'):
-            attr1 = attr[:-len(ending)]
-            if (attr.endswith(ending)
-                    and attr1 in cls_dict
-                    and isinstance(cls_dict[attr1], StateValue)):
-                return cls_dict[attr1].values if (ending == 's') else cls_dict[attr1].dates
-
-        return super(Spacecraft, self).__getattribute__(attr)
-
     def add_cmd(self, **cmd):
         """
         Add command in correct order to the commands list.
@@ -196,25 +294,45 @@ class Spacecraft(object, metaclass=SpacecraftMeta):
         """
         cmd_date = cmd['date']
 
-        logger.debug('Adding command %s', cmd)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Adding command %s', cmd)
 
         # Prevent adding command before current command since the command
         # interpreter is a one-pass process.
         if cmd_date < self.date:
             raise ValueError('cannot insert command {} prior to current command {}'
-                             .format(cmd, self.curr_cmd))
-
-        # Insert command at first place where new command date is strictly
-        # less than existing command date.  This implementation is linear, and
-        # could be improved, though in practice commands are often inserted
-        # close to the original.
-        cmds = self.cmds
-        for i_cmd in range(self.i_cmd + 1, len(cmds)):
-            if cmd_date < cmds[i_cmd]['date']:
-                cmds.insert(i_cmd, cmd)
-                break
-        else:
-            cmds.append(cmd)
+                             .format(cmd, self.cmds[self.i_cmd]))
+
+        # Insert command at first place after the current command where new
+        # command date is strictly less than existing command date.  Date
+        # strings in Year DOY format sort chronologically so a binary search on
+        # the parallel list of dates finds this point.
+        i_cmd = bisect_right(self._cmd_dates, cmd_date, lo=self.i_cmd + 1)
+        self.cmds.insert(i_cmd, cmd)
+        self._cmd_dates.insert(i_cmd, cmd_date)
+
+    def add_cmds(self, cmds):
+        """
+        Add a list of commands in correct order to the commands list.
+
+        This gives the same result as calling ``add_cmd`` for each command in
+        turn, but does a single sort of the commands after the current command
+        instead of one insertion per command.
+
+        :param cmds: list of command dicts
+        """
+        for cmd in cmds:
+            if cmd['date'] < self.date:
+                raise ValueError('cannot insert command {} prior to current command {}'
+                                 .format(cmd, self.cmds[self.i_cmd]))
+
+        # The stable sort keeps new commands after existing commands with the
+        # same date and otherwise in the order given, as for add_cmd.
+        i_cmd0 = self.i_cmd + 1
+        cmds = self.cmds[i_cmd0:] + list(cmds)
+        cmds.sort(key=itemgetter('date'))
+        self.cmds[i_cmd0:] = cmds
+        self._cmd_dates[i_cmd0:] = [cmd['date'] for cmd in cmds]
 
     def add_action(self, action, date, **kwargs):
         """
@@ -231,9 +349,13 @@ class Spacecraft(object, metaclass=SpacecraftMeta):
 
     def add_check(self, name, date, **kwargs):
         """
-        Add check ``name`` at ``date``
+        Add check ``name`` at ``date``.  Checks with the same date are kept
+        in the order they were added.
         """
-        self.checks.append(CHECK_CLASSES[name](as_date(date), **kwargs))
+        check = CHECK_CLASSES[name](as_date(date), **kwargs)
+        idx = bisect_right(self._check_dates, check.date)
+        self._check_dates.insert(idx, check.date)
+        self.checks.insert(idx, check)
 
     def is_obs_req(self):
         """
@@ -241,56 +363,134 @@ class Spacecraft(object, metaclass=SpacecraftMeta):
         """
         return self.obsid < 38000
 
+    def get_obsreq_target(self, obsid):
+        """
+        Get the science target for ``obsid`` from the OR list as a tuple of
+        ``(y_off, z_off, ra, dec)``.
+
+        The Y, Z offsets include the dynamical offset attributes ``aca_offset_y``
+        and ``aca_offset_z`` which are available for loads planned with Matlab
+        tools 2016_210 and later.  These pseudo-attributes must be injected by
+        calling code.  Results are cached by obsid.
+
+        :param obsid: obsid in the OR list
+        """
+        if obsid not in self._obsreq_targets:
+            obsreq = self.obsreqs[obsid]
+            self._obsreq_targets[obsid] = (
+                obsreq['target_offset']['y_offset'] + obsreq.get('aca_offset_y', 0),
+                obsreq['target_offset']['z_offset'] + obsreq.get('aca_offset_z', 0),
+                obsreq['target']['ra'],
+                obsreq['target']['dec'])
+
+        return self._obsreq_targets[obsid]
+
     def set_state_value(self, date, name, value):
         """
-        Update the current self.states list to reflect the new setting of state
-        ``name=value`` at ``date``.
+        Record the new setting of state ``name=value`` at ``date`` in the log of
+        state changes and update the current state ``self.state``.
 
         :param date: date of state transition
         :param name: name of state parameter
         :param value: value of state parameter
         """
-        # During first initialization of SC state values there is no state so
-        # just ignore these calls.
-        if not hasattr(self, 'states'):
-            return
-
         date = as_date(date)
-        states = self.states
+        self._state_deltas.append((date, name, value))
+        self.state[name] = value
+        self.state['date'] = date
+        self._states = None
 
-        # Create a new state if date has changed.  Note use of shallow copy.
-        if states[-1]['date'] != date:
-            states.append(copy(states[-1]))
-            states[-1]['date'] = date
+    @property
+    def states(self):
+        """
+        List of state dicts, with a new state for each date at which any state
+        value changed.  This is built from the log of state changes when first
+        accessed after a change.
+
+        This is read-only: state history is changed by setting state values
+        (e.g. ``SC.obsid = 1234``).  The attribute cannot be assigned, and
+        changes made to the returned list are discarded when it is rebuilt
+        after the next state change.
+        """
+        if self._states is None:
+            state = self._state0.copy()
+            states = [state]
+            state_dates = [as_date(state['date'])]
+            for date, name, value in self._state_deltas:
+                # Create a new state if date has changed.  Note use of shallow copy.
+                if state['date'] != date:
+                    state = state.copy()
+                    state['date'] = date
+                    states.append(state)
+                    state_dates.append(date)
+                state[name] = value
+            self._states = states
+            self._state_dates = state_dates
+
+        return self._states
+
+    def state_at(self, date):
+        """
+        Return the state dict in effect at ``date``, i.e. the last state in
+        ``self.states`` at or before ``date``.  Returns None if ``date`` is
+        before the first state.
 
-        states[-1][name] = value
+        :param date: time-like input
+        :returns: state dict or None
+        """
+        states = self.states
+        idx = bisect_right(self._state_dates, as_date(date)) - 1
+        return states[idx] if (idx >= 0) else None
 
     @property
     def q_att(self):
-        return Quat([self.q1, self.q2, self.q3, self.q4])
+        return _quat(self.q1, self.q2, self.q3, self.q4)
+
+    @property
+    def targ_q_att(self):
+        return _quat(self.targ_q1, self.targ_q2, self.targ_q3, self.targ_q4)
 
     @property
     def detector(self):
-        for si, lims in (('HRC-S', (-400000.0, -85000.0)),
-                         ('HRC-I', (-85000.0, 0.0)),
-                         ('ACIS-S', (0.0, 83000.0)),
-                         ('ACIS-I', (83000.0, 400000.0))):
-            lim0, lim1 = lims
-            if lims[0] < self.simpos <= lims[1]:
-                return si
-        else:
-            raise ValueError('illegal value of sim_tsc: {}'.format(self.simpos))
+        return _detector_for(self.simpos)
+
+    def get_states_array(self):
+        """
+        Return the state history ``self.states`` as a numpy structured array.
+
+        Columns where every value has the same scalar type (e.g. ``q1`` or
+        ``simpos``) get a native numpy dtype while any other column (e.g.
+        ``maneuver`` or ``starcat``, a state that is undefined at the start, or a
+        mix of types such as bool and int) is stored as ``object``.  Dates are
+        in Year DOY format.
+        """
+        states = self.states
+        scalar_types = (bool, int, float, str)
+
+        cols = {}
+        for name in states[0]:
+            col = np.empty(len(states), dtype=object)
+            for idx, state in enumerate(states):
+                col[idx] = as_date(state[name]) if name == 'date' else state[name]
+            col_types = set(type(val) for val in col)
+            if len(col_types) == 1 and col_types.pop() in scalar_types:
+                col = np.array(col.tolist())
+            cols[name] = col
+
+        out = np.empty(len(states), dtype=[(name, col.dtype) for name, col in cols.items()])
+        for name, col in cols.items():
+            out[name] = col
+        return out
 
     def get_checks_by_obsid(self):
         """
         Return checks organized by obsid
         """
-        checks = OrderedDict()
-        for obsid in self.obsids:
-            checks[obsid] = []
-
+        # Pre-allocate a list for each obsid in order of appearance (dict is
+        # insertion-ordered), falling back to a new list for any other obsid.
+        checks = {obsid: [] for obsid in self.obsids}
         for check in self.checks:
-            checks[check.obsid].append(check)
+            checks.setdefault(check.obsid, []).append(check)
 
         return checks
 
@@ -321,7 +521,11 @@ def run_cmds(cmds, or_list=None, ofls_characteristics_file=None,
     if ofls_characteristics_file:
         odb_si_align = parse_cm.read_characteristics(ofls_characteristics_file,
                                                      item='ODB_SI_ALIGN')
-        characteristics = {'odb_si_align': odb_si_align}
+        # Pre-compute the SI align quaternion for each detector so the science
+        # target check does not convert the transform matrix on every call.
+        odb_si_align_quat = {det: Quat(si_align) for det, si_align in odb_si_align.items()}
+        characteristics = {'odb_si_align': odb_si_align,
+                           'odb_si_align_quat': odb_si_align_quat}
     else:
         characteristics = None
 
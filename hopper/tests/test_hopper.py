@@ -2,7 +2,7 @@
 
 
 import os
-import glob
+from collections import defaultdict
 
 
 import pytest
@@ -12,38 +12,59 @@ import astropy.units as u
 import parse_cm
 import hopper
 import hopper.base_cmd
+import hopper.utils
 
 root = os.path.dirname(__file__)
+NOV0512 = os.path.join(root, 'NOV0512')
 
 
-def run_hopper(backstop_file, or_list_file=None,
+def run_hopper(backstop, or_list=None,
                ofls_characteristics_file=None, initial_state=None):
     # Run the commands and populate attributes in `sc`, the spacecraft state.
+    # `backstop` and `or_list` can be file names or already-parsed commands
+    # and OR list dict, as for hopper.run_cmds.
     # In particular sc.checks is a dict of checks by obsid.
     # Any state value (e.g. obsid or q1) has a corresponding plural that
     # gives the history of updates as a dict with a `value` and `date` key.
-    sc = hopper.run_cmds(backstop_file, or_list_file, ofls_characteristics_file, initial_state)
+    sc = hopper.run_cmds(backstop, or_list, ofls_characteristics_file, initial_state)
 
-    all_ok = True
+    checks_by_obsid = sc.get_checks_by_obsid()
+    all_ok = all(check.success for checks in checks_by_obsid.values() for check in checks)
 
     # Iterate through obsids in order
-    lines = []
-    for obsid, checks in sc.get_checks_by_obsid().items():
-        for check in checks:
-            all_ok &= check.success
-            for msg in check.messages:
-                lines.append('{} {}: {}'.format(obsid, msg['category'], msg['text']))
+    fmt = '{} {}: {}'.format
+    lines = [fmt(obsid, msg['category'], msg['text'])
+             for obsid, checks in checks_by_obsid.items()
+             for check in checks
+             for msg in check.messages]
 
     return all_ok, lines, sc
 
 
-def run_nov0512(with_characteristics=True):
+@pytest.fixture(scope='session')
+def nov0512_parsed():
     """
-    Minimal example of running checks from Python
+    NOV0512 backstop commands and OR list parsed once per test session
     """
-    or_list_file = os.path.join(root, 'NOV0512', 'or_list')
-    backstop_file = os.path.join(root, 'NOV0512', 'backstop')
-    ofls_characteristics_file = (os.path.join(root, 'NOV0512', 'CHARACTERIS_12MAR15')
+    backstop_cmds = tuple(hopper.utils.get_backstop_cmds(os.path.join(NOV0512, 'backstop')))
+    obsreqs, _ = parse_cm.read_or_list_full(os.path.join(NOV0512, 'or_list'))
+    return backstop_cmds, obsreqs
+
+
+def run_nov0512(with_characteristics=True, parsed=None):
+    """
+    Minimal example of running checks from Python.  By default this reads the
+    backstop and OR list files; ``parsed`` can instead supply already-parsed
+    ``(backstop_cmds, obsreqs)``.
+    """
+    if parsed is None:
+        backstop = os.path.join(NOV0512, 'backstop')
+        or_list = os.path.join(NOV0512, 'or_list')
+    else:
+        backstop_cmds, or_list = parsed
+        # Spacecraft inserts commands into its list so pass a new list each time
+        backstop = list(backstop_cmds)
+    ofls_characteristics_file = (os.path.join(NOV0512, 'CHARACTERIS_12MAR15')
                                  if with_characteristics else None)
     initial_state = {'q1': -3.41366779e-02,
                      'q2': 6.48062295e-01,
@@ -52,7 +73,7 @@ def run_nov0512(with_characteristics=True):
                      'simpos': 75624,
                      'simfa_pos': -468,
                      'date': '2012-11-10 00:00:00'}
-    ok, lines, sc = run_hopper(backstop_file, or_list_file,
+    ok, lines, sc = run_hopper(backstop, or_list,
                                ofls_characteristics_file, initial_state)
     return ok, lines, sc
 
@@ -63,25 +84,30 @@ def test_nov0512_with_characteristics():
                          'different from OR list by 3.6 arcsec']
     assert not ok
 
-def test_nov0512_as_planned():
+def test_nov0512_as_planned(nov0512_parsed):
     """NOV0512 the way it really is.  This is how old loads with no characteristics will
-    process when run through the checker."""
-    ok, lines, sc = run_nov0512(with_characteristics=False)
+    process when run through the checker.  This also checks running from
+    already-parsed commands and OR list."""
+    ok, lines, sc = run_nov0512(with_characteristics=False, parsed=nov0512_parsed)
     # hopper.pcad now uses the default ODB_SI_ALIGN if not supplied,
     # so we get this warning from the edited 13781 either way
     assert lines == ['13871 error: science target attitude RA=160.63125 Dec=5.04381 '
                          'different from OR list by 3.6 arcsec']
     assert not ok
 
-    manvrs = parse_cm.read_maneuver_summary(os.path.join(root, 'NOV0512', 'manvr_summary'),
+    manvrs = parse_cm.read_maneuver_summary(os.path.join(NOV0512, 'manvr_summary'),
                                             structured=True)
 
     # Make sure maneuvers are consistent with OFLS maneuver summary file
     assert len(manvrs) == len(sc.maneuvers)
-    for manvr, sc_manvr in zip(manvrs, sc.maneuvers):
-        for initfinal in ('initial', 'final'):
-            for q in ('q1', 'q2', 'q3', 'q4'):
-                assert np.allclose(manvr[initfinal][q], sc_manvr[initfinal][q], atol=1e-7)
+
+    def manvr_quats(manvrs):
+        # (N, 2, 4) array of initial and final quaternions for N maneuvers
+        return np.array([[[manvr[initfinal][q] for q in ('q1', 'q2', 'q3', 'q4')]
+                          for initfinal in ('initial', 'final')]
+                         for manvr in manvrs], dtype=float)
+
+    assert np.allclose(manvr_quats(manvrs), manvr_quats(sc.maneuvers), atol=1e-7)
 
 
 def test_dither_commanding():
@@ -95,16 +121,81 @@ def test_dither_commanding():
     assert sc.dither_enabled is True
 
     allclose = lambda a, b: np.allclose(a, b, rtol=0, atol=0.01)
-    assert allclose(sc.dither_phase_pitch, 0.0)
-    assert allclose(sc.dither_phase_yaw, 0.0)
-    assert allclose(sc.dither_ampl_pitch, 4.0)  # arcsec
-    assert allclose(sc.dither_ampl_yaw, 8.0)
-    assert allclose(sc.dither_period_pitch, 707.423)  # seconds
-    assert allclose(sc.dither_period_yaw, 1000.0)
+    # Phase (deg), amplitude (arcsec) and period (sec) for pitch and yaw
+    dither = [sc.dither_phase_pitch, sc.dither_phase_yaw,
+              sc.dither_ampl_pitch, sc.dither_ampl_yaw,
+              sc.dither_period_pitch, sc.dither_period_yaw]
+    assert allclose(dither, [0.0, 0.0, 4.0, 8.0, 707.423, 1000.0])
 
     sc.date = '2015:289:00:00:01.000'
     assert sc.dither_enabled is False
 
+    # Same values from the state history
+    assert sc.state_at('2015:288:00:00:01.000')['dither_enabled'] is True
+    assert sc.state_at('2015:289:00:00:00.000')['dither_enabled'] is False
+    assert allclose(sc.state_at('2015:288:00:00:01.000')['dither_ampl_pitch'], 4.0)
+
+    # Values at several dates at once, in any time format
+    dates = ['1998:001:00:00:00.000', '2015-10-15T00:00:01.000', '2015:289:00:00:01.000']
+    assert hopper.Spacecraft.dither_enabled.get_many(dates) == [None, True, False]
+    ampls = hopper.Spacecraft.dither_ampl_pitch.get_many(dates)
+    assert ampls[0] is None
+    assert allclose(ampls[1:], [4.0, 4.0])
+
+
+def test_states_array():
+    backstop = """
+2015:288:00:00:00.000 |  7637436 0 | COMMAND_SW       | TLMSID= AOENDITH, HEX= 8034301, MSID= AOENDITH, SCS= 128, STEP= 632
+2015:289:00:00:00.000 |  7637436 0 | COMMAND_SW       | TLMSID= AODSDITH, HEX= 8034301, MSID= AODSDITH, SCS= 128, STEP= 632
+2015:289:00:00:00.000 |  7637436 0 | SIMTRANS         | POS= -99616, SCS= 130, STEP= 1"""
+
+    sc = hopper.run_cmds(backstop, initial_state={'simpos': 75624.5})
+    states = sc.get_states_array()
+    assert states['date'].tolist() == ['1999:001:00:00:00.000',
+                                       '2015:288:00:00:00.000',
+                                       '2015:289:00:00:00.000']
+    assert states['dither_enabled'].dtype == bool
+    assert states['dither_enabled'].tolist() == [True, True, False]
+    assert states['q4'].dtype == np.float64
+    assert states['q4'].tolist() == [1.0, 1.0, 1.0]
+    assert states['simfa_pos'].dtype.kind == 'i'
+    # Undefined at the start, or a mix of float and int
+    assert states['obsid'].dtype == object
+    assert states['simpos'].dtype == object
+    assert states['simpos'].tolist() == [75624.5, 75624.5, -99616]
+
+    # Initial date in another format is converted to Year DOY
+    sc = hopper.run_cmds(backstop, initial_state={'date': '2015-10-14 00:00:00'})
+    dates = sc.get_states_array()['date']
+    assert dates[0] == '2015:287:00:00:00.000'
+    assert all(len(date) == 21 for date in dates)
+
+
+def test_custom_trigger():
+    """A class with its own trigger is a candidate for commands that do not
+    match the type / tlmsid of its cmd_trigger."""
+    class FakeCustomTriggerCmd(hopper.base_cmd.Cmd):
+        cmd_trigger = {'type': 'FAKE', 'tlmsid': 'FAKE1'}
+
+        @classmethod
+        def trigger(cls, cmd):
+            return cmd.get('tlmsid') in ('FAKE1', 'CUSTOM')
+
+        def run(self):
+            pass
+
+    cmd = {'type': 'OTHER', 'tlmsid': 'CUSTOM'}
+    assert FakeCustomTriggerCmd in hopper.base_cmd.get_cmd_action_classes(cmd)
+
+    backstop = """
+    2015:001:00:00:00.000 | 0 0 | OTHER | TLMSID=CUSTOM
+    2015:001:00:00:10.000 | 0 0 | OTHER | TLMSID=NOMATCH
+    """
+    sc = hopper.run_cmds(backstop)
+    dates = [cmd_action.cmd['date'] for cmd_action in sc.cmd_actions
+             if isinstance(cmd_action, FakeCustomTriggerCmd)]
+    assert dates == ['2015:001:00:00:00.000']
+
 
 def test_cmd_sequence_check():
     backstop = """
@@ -150,8 +241,12 @@ def test_large_dither():
     sc = hopper.Spacecraft(backstop)
     sc.run()
 
+    checks_by_name = defaultdict(list)
+    for check in sc.checks:
+        checks_by_name[check.name].append(check)
+
     # Cmd sequence checks
-    checks = [check for check in sc.checks if check.name == 'large_dither_cmd_sequence']
+    checks = checks_by_name['large_dither_cmd_sequence']
     assert len(checks) == 2
     assert checks[0].not_applicable is True
     assert checks[1].not_applicable is False
@@ -160,7 +255,7 @@ def test_large_dither():
     assert checks[1].matches[0]['date'] == '2015:063:00:45:12.746'
     assert checks[1].matches[1]['date'] == '2015:063:00:51:12.746'
 
-    checks = [check for check in sc.checks if check.name == 'standard_dither']
+    checks = checks_by_name['standard_dither']
     assert len(checks) == 2
     assert checks[0].warnings == checks[0].errors == []
     assert checks[1].warnings == ['non-standard dither amplitude or period']
@@ -1,10 +1,24 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 
 import os
+import re
+from functools import lru_cache
 
 import parse_cm
 from cxotime import CxoTime
 
+# Boundary between a non-upper-case character and an upper-case character
+_CAMEL_CASE_BOUNDARY = re.compile(r'(?<=[^A-Z])(?=[A-Z])')
+
+
+@lru_cache(maxsize=4096)
+def _str_as_date(time):
+    """
+    Return date string ``time`` in Year DOY format.  Results are cached since
+    the same date strings recur across commands, actions and checks.
+    """
+    return CxoTime(time).yday
+
 
 def as_date(time, quick=True):
     """
@@ -13,12 +27,27 @@ def as_date(time, quick=True):
     :param time: time-like input
     :param quick: assume a 21-character string is already in YDAY format
     """
-    if quick and isinstance(time, str) and len(time) == 21:
-        return time
+    if isinstance(time, str):
+        if quick and len(time) == 21:
+            return time
+        return _str_as_date(time)
+    elif isinstance(time, CxoTime):
+        return time.yday
     else:
         return CxoTime(time).yday
 
 
+def as_dates(times):
+    """
+    Return ``times`` in Year DOY format (aka 'date') as a numpy array, using a
+    single CxoTime conversion for all values.
+
+    :param times: list or array of time-like inputs
+    """
+    return CxoTime(times).yday
+
+
+@lru_cache(maxsize=1024)
 def un_camel_case(cc_name):
     """
     Change ``CamelCaseNName`` to ``camel_case_nname``.  Note behavior
@@ -26,15 +55,8 @@ def un_camel_case(cc_name):
 
     :param cc_name: input camel-cased name
     """
-    chars = []
-    for c0, c1 in zip(cc_name[:-1], cc_name[1:]):
-        # Lower case followed by Upper case then insert "_"
-        chars.append(c0.lower())
-        if c0.lower() == c0 and c1.lower() != c1:
-            chars.append('_')
-    chars.append(c1.lower())
-
-    return ''.join(chars)
+    # Lower case (or digit etc) followed by Upper case then insert "_"
+    return _CAMEL_CASE_BOUNDARY.sub('_', cc_name).lower()
 
 
 def get_backstop_cmds(content):
@@ -45,8 +67,8 @@ def get_backstop_cmds(content):
 
     :param content: backstop content or file name (str)
     """
-    lines = content.splitlines()
-    if len(lines) > 1:
-        content = [line_strip for line in lines if (line_strip := line.strip())]
+    if '\n' in content:
+        content = [line_strip for line in content.splitlines()
+                   if (line_strip := line.strip())]
 
     return parse_cm.read_backstop_as_list(content)
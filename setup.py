@@ -1,5 +1,5 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
-from setuptools import setup
+from setuptools import setup, find_packages
 
 try:
      from testr.setup_helper import cmdclass
@@ -13,7 +13,8 @@ setup(name='hopper',
       use_scm_version=True,
       setup_requires=['setuptools_scm', 'setuptools_scm_git_archive'],
       zip_safe=False,
-      packages=['hopper', 'hopper.tests'],
+      python_requires='>=3.8',
+      packages=find_packages(include=['hopper', 'hopper.*']),
       package_data={'hopper.tests': ['NOV0512/*']},
       tests_require=['pytest'],
       cmdclass=cmdclass,